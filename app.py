@@ -2,22 +2,113 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
+import hashlib
+import os
+import tempfile
 from io import BytesIO
+from pathlib import Path
+
+from kernels import demand_all, fluxos
 
 # -----------------------------------
 # FUNÇÃO PARA GERAR MODELO DE DADOS
 # -----------------------------------
+MODELO_DADOS = (
+    ("Resgates_Brutos", (100000, 0, 500000, 150000, 200000)),
+    ("Aportes_do_Dia", (50000, 200000, 0, 100000, 50000)),
+    ("Patrimonio_Liquido", (10000000, 10100000, 9800000, 9600000, 9500000)),
+)
+
+@st.cache_data(ttl=None)
 def gerar_template():
-    df = pd.DataFrame({
-        "Resgates_Brutos": [100000, 0, 500000, 150000, 200000],
-        "Aportes_do_Dia": [50000, 200000, 0, 100000, 50000],
-        "Patrimonio_Liquido": [10000000, 10100000, 9800000, 9600000, 9500000]
-    })
+    df = pd.DataFrame.from_dict(dict(MODELO_DADOS))
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
         df.to_excel(writer, index=False)
     return output.getvalue()
 
+# -----------------------------------
+# LEITURA DO HISTÓRICO (CACHE POR CONTEÚDO DO ARQUIVO)
+# -----------------------------------
+CACHE_DIR = Path(tempfile.gettempdir()) / "liq_cache"
+# Incrementar sempre que _parse mudar (engine, limpeza de colunas, dtypes),
+# para que parquets gravados pela versão anterior não sejam reaproveitados
+CACHE_VERSION = b"v1"
+CACHE_MAX_FILES = 32
+
+def _parse(file_bytes: bytes, name: str) -> pd.DataFrame:
+    buffer = BytesIO(file_bytes)
+    df = pd.read_csv(buffer, engine="pyarrow") if name.endswith(".csv") else pd.read_excel(buffer, engine="calamine")
+    df.columns = [c.strip() for c in df.columns]
+    return df
+
+def _prune_cache():
+    """Mantém só os CACHE_MAX_FILES parquets mais recentes (por mtime)."""
+    arquivos = sorted(CACHE_DIR.glob("*.parquet"), key=lambda f: f.stat().st_mtime, reverse=True)
+    for f in arquivos[CACHE_MAX_FILES:]:
+        f.unlink(missing_ok=True)
+
+@st.cache_data(max_entries=8)
+def _load(file_bytes: bytes, name: str) -> pd.DataFrame:
+    """
+    Lê o arquivo enviado uma única vez por conteúdo + nome;
+    reruns do script reaproveitam o DataFrame já parseado.
+    Em disco fica uma cópia em parquet, que sobrevive a reinícios do processo.
+    """
+    h = hashlib.blake2b(file_bytes, digest_size=16)
+    h.update(Path(name).suffix.encode())
+    h.update(CACHE_VERSION)
+    p = CACHE_DIR / f"{h.hexdigest()}.parquet"
+    if p.exists():
+        try:
+            df = pd.read_parquet(p)
+            p.touch()  # mantém os arquivos em uso entre os mais recentes na poda
+            return df
+        except (OSError, ValueError):
+            # arquivo truncado/corrompido: descarta e parseia de novo
+            p.unlink(missing_ok=True)
+
+    df = _parse(file_bytes, name)
+    tmp = None
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # grava num temporário e troca atomicamente, para que nenhum leitor
+        # veja um parquet pela metade (processo morto, uploads simultâneos)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        df.to_parquet(tmp, compression="zstd")
+        os.replace(tmp, p)
+        _prune_cache()
+    except (OSError, TypeError, ValueError):
+        # sem disco gravável (ou colunas que o parquet não aceita), fica só o cache em memória
+        if tmp is not None:
+            Path(tmp).unlink(missing_ok=True)
+    return df
+
+REQUIRED_COLS = {"Resgates_Brutos", "Aportes_do_Dia", "Patrimonio_Liquido"}
+
+@st.cache_data(max_entries=8)
+def _features(file_bytes: bytes, name: str) -> tuple[pd.DataFrame | None, str | None]:
+    """
+    Valida as colunas e deriva os fluxos (líquido e de risco) do histórico,
+    uma única vez por arquivo. Devolve também a chave do histórico para o
+    cache da demanda, ou (None, None) se faltar alguma coluna obrigatória.
+    """
+    # st.cache_data devolve uma cópia a cada chamada, então mutar df é seguro
+    df = _load(file_bytes, name)
+    if not REQUIRED_COLS.issubset(df.columns):
+        return None, None
+
+    # float64: em float32 fluxos acima de ~R$167 mil já perdem os centavos
+    df = df.astype({"Resgates_Brutos": "float64", "Aportes_do_Dia": "float64"})
+    # ---- NENHUMA INVERSÃO: assumimos que a linha 0 já é o dia mais recente ----
+    fl, fr = fluxos(df["Aportes_do_Dia"].to_numpy(), df["Resgates_Brutos"].to_numpy())
+    df["Fluxo_Liquido"] = fl
+    df["Fluxo_Risco"] = fr
+    # Hash do buffer na ordem das linhas: as somas móveis dependem da ordem
+    hist_hash = hashlib.blake2b(np.ascontiguousarray(fr), digest_size=16).hexdigest()
+    return df, hist_hash
+
 # -----------------------------------
 # SIDEBAR - CONFIGURAÇÕES
 # -----------------------------------
@@ -40,20 +131,14 @@ upload_file = st.sidebar.file_uploader("Upload CSV/XLSX (Histórico)", type=["cs
 # CARREGAMENTO E PROCESSAMENTO DOS DADOS
 # -----------------------------------
 if upload_file:
-    df_hist = pd.read_csv(upload_file) if upload_file.name.endswith(".csv") else pd.read_excel(upload_file)
-    df_hist.columns = [c.strip() for c in df_hist.columns]
+    df_hist, hist_hash = _features(upload_file.getvalue(), upload_file.name)
 
-    required_cols = {"Resgates_Brutos", "Aportes_do_Dia", "Patrimonio_Liquido"}
-    if not required_cols.issubset(df_hist.columns):
+    if df_hist is None:
         st.error("A planilha deve conter as colunas: Resgates_Brutos, Aportes_do_Dia e Patrimonio_Liquido")
         st.stop()
 
     st.success("Dados históricos carregados com sucesso!")
 
-    # ---- NENHUMA INVERSÃO: assumimos que a linha 0 já é o dia mais recente ----
-    df_hist["Fluxo_Liquido"] = df_hist["Aportes_do_Dia"] - df_hist["Resgates_Brutos"]
-    df_hist["Fluxo_Risco"] = df_hist["Fluxo_Liquido"].apply(lambda x: abs(x) if x < 0 else 0)
-
     # O PL mais recente está na linha 0
     pl_total = df_hist["Patrimonio_Liquido"].iloc[0]
 
@@ -61,11 +146,20 @@ else:
     st.warning("⚠️ Sem histórico carregado — valores simulados serão usados.")
     pl_total = st.sidebar.number_input("PL (R$) para simulação", value=10000000.0)
     df_hist = None
+    hist_hash = None
 
 # -----------------------------------
 # DEMANDA ESTRESSADA (COM JANELA HISTÓRICA)
 # -----------------------------------
-def demanda_estressada(historico, window_length):
+@st.cache_data(max_entries=8)
+def _demanda_hist(hist_hash: str, window_length: int, _risco: np.ndarray) -> float:
+    """
+    Cacheado por (hash do histórico, janela): mexer na carteira ou no prazo
+    do FoF não refaz as somas móveis. _risco não entra na chave.
+    """
+    return float(demand_all(_risco, np.array([window_length], dtype=np.int64))[0])
+
+def demanda_estressada(historico, window_length, hist_hash):
     """
     Para um horizonte window_length (dias),
     calcula o percentil 99 da soma de resgates negativos acumulados
@@ -75,16 +169,7 @@ def demanda_estressada(historico, window_length):
     if historico is None or len(historico) < window_length:
         return 0.0
 
-    risco = historico["Fluxo_Risco"].values
-    rolling_sums = []
-    for start in range(0, len(risco) - window_length + 1):
-        window_sum = risco[start : start + window_length].sum()
-        rolling_sums.append(window_sum)
-
-    if len(rolling_sums) == 0:
-        return 0.0
-
-    return float(np.percentile(rolling_sums, 99))
+    return _demanda_hist(hist_hash, window_length, historico["Fluxo_Risco"].to_numpy())
 
 # -----------------------------------
 # VÉRTICES PARA CÁLCULO
@@ -92,81 +177,126 @@ def demanda_estressada(historico, window_length):
 vertices = sorted(list({1, 5, 21, 42, 63, prazo_resgate_fof}))
 
 # Agora, em vez de usar "v" como tamanho
-# usamos sempre "janela_hist" para toda demanda estressada
-demanda_por_vertice = {}
-for v in vertices:
-    demanda_por_vertice[v] = demanda_estressada(df_hist, janela_hist)
+# usamos sempre "janela_hist" para toda demanda estressada:
+# uma única passada sobre o histórico serve a todos os vértices
+demanda_hist = demanda_estressada(df_hist, janela_hist, hist_hash)
+demanda_por_vertice = dict.fromkeys(vertices, demanda_hist)
+
+# -----------------------------------
+# GRÁFICO: OFERTA VS DEMANDA
+# -----------------------------------
+@st.cache_resource(max_entries=16)
+def _build_fig(vertices_lbl, oferta, demanda):
+    """
+    A mesma figura é reaproveitada entre reruns enquanto as séries não mudam.
+    Recebe tuplas para que os argumentos sejam hasheáveis.
+    A figura é compartilhada entre sessões: só leia, nunca altere o retorno.
+    """
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=vertices_lbl, y=oferta, name="Oferta Acumulada", marker_color="#00CC96"))
+    fig.add_trace(go.Scatter(x=vertices_lbl, y=demanda,
+                             name="Demanda Estressada", line=dict(color="red", width=3)))
+    fig.update_layout(title="Cobertura de Liquidez por Vértice", barmode="group", hovermode="x unified")
+    return fig
 
 # -----------------------------------
 # CARTEIRA DE FUNDOS INVESTIDOS
 # -----------------------------------
-st.header("📋 Carteira de Fundos Investidos")
+@st.fragment
+def _carteira_block(pl_total, demanda_por_vertice, vertices, prazo_resgate_fof):
+    """
+    Carteira, IL, KPIs, gráfico e alertas. Como fragmento, editar a carteira
+    reexecuta só este bloco; a leitura do histórico e a demanda ficam de fora.
+    """
+    st.header("📋 Carteira de Fundos Investidos")
 
-if "n_ativos" not in st.session_state:
-    st.session_state.n_ativos = 3
+    # A carteira padrão divide o PL atual entre os fundos; enquanto o usuário
+    # não editar a tabela, ela acompanha o PL (ex.: simulado -> histórico carregado)
+    edicoes = st.session_state.get("ce") or {}
+    editada = any(edicoes.get(k) for k in ("edited_rows", "added_rows", "deleted_rows"))
+    if "carteira" not in st.session_state or (st.session_state.get("carteira_pl") != pl_total and not editada):
+        n_ativos = 3
+        st.session_state["carteira"] = pd.DataFrame({
+            "Fundo": [f"Fundo {i+1}" for i in range(n_ativos)],
+            "Prazo": [0] * n_ativos,
+            "Valor": [pl_total / n_ativos] * n_ativos
+        })
+        st.session_state["carteira_pl"] = pl_total
 
-if st.button("➕ Adicionar Fundo"):
-    st.session_state.n_ativos += 1
+    # Um único widget para a carteira inteira (linhas podem ser adicionadas/removidas)
+    carteira = st.data_editor(
+        st.session_state["carteira"],
+        num_rows="dynamic",
+        key="ce",
+        column_config={
+            "Fundo": st.column_config.TextColumn("Nome Fundo"),
+            "Prazo": st.column_config.NumberColumn("Prazo de Liquidez (D+)", min_value=0, step=1),
+            "Valor": st.column_config.NumberColumn("Valor (R$)", min_value=0.0)
+        }
+    )
 
-ativos = []
-for i in range(st.session_state.n_ativos):
-    c1, c2, c3 = st.columns([3, 2, 2])
-    nome = c1.text_input(f"Nome Fundo {i+1}", f"Fundo {i+1}", key=f"nome{i}")
-    prazo = c2.number_input(f"Prazo de Liquidez (D+)", min_value=0, value=0, key=f"prazo{i}")
-    valor = c3.number_input(f"Valor (R$)", min_value=0.0, value=pl_total/st.session_state.n_ativos, key=f"valor{i}")
-    ativos.append({"Fundo": nome, "Prazo": prazo, "Valor": valor})
+    # Oferta e mismatch são calculados direto sobre arrays NumPy
+    prazo = carteira["Prazo"].fillna(0).to_numpy(dtype=np.int64)
+    valor = carteira["Valor"].fillna(0.0).to_numpy(dtype=np.float64)
 
-df_carteira = pd.DataFrame(ativos)
+    # -----------------------------------
+    # CÁLCULO DO ÍNDICE DE LIQUIDEZ (IL)
+    # -----------------------------------
+    # Curva de oferta acumulada: ordena os fundos por prazo uma vez e
+    # localiza cada vértice por busca binária, sem uma máscara por vértice
+    order = np.argsort(prazo, kind="stable")
+    prazo_s = prazo[order]
+    # val_cum[k] = soma dos k fundos de menor prazo (val_cum[0] = 0)
+    val_cum = np.concatenate(([0.0], np.cumsum(valor[order])))
 
-# -----------------------------------
-# CÁLCULO DO ÍNDICE DE LIQUIDEZ (IL)
-# -----------------------------------
-resultados = []
-for v in vertices:
-    oferta = df_carteira[df_carteira["Prazo"] <= v]["Valor"].sum()
-    demanda_v = demanda_por_vertice[v]
-    il_v = oferta / demanda_v if demanda_v > 0 else np.nan
-    resultados.append({
-        "Vértice": f"D+{v}",
-        "Oferta": oferta,
-        "DemandaEstressada": demanda_v,
-        "IL": il_v
+    vertices_arr = np.asarray(vertices, dtype=np.int64)
+    idx = np.searchsorted(prazo_s, vertices_arr, side="right")
+    oferta_vec = val_cum[idx]
+    demanda_vec = np.array([demanda_por_vertice[v] for v in vertices], dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        il_vec = np.where(demanda_vec > 0, oferta_vec / demanda_vec, np.nan)
+
+    df_il = pd.DataFrame({
+        "Vértice": [f"D+{v}" for v in vertices],
+        "Oferta": oferta_vec,
+        "DemandaEstressada": demanda_vec,
+        "IL": il_vec
     })
 
-df_il = pd.DataFrame(resultados)
+    # -----------------------------------
+    # KPIs PRINCIPAIS
+    # -----------------------------------
+    il_fof = il_vec[vertices.index(prazo_resgate_fof)]
+    mismatch_val = valor[prazo > prazo_resgate_fof].sum()
+    mismatch_perc = (mismatch_val / pl_total * 100) if pl_total > 0 else 0
 
-# -----------------------------------
-# KPIs PRINCIPAIS
-# -----------------------------------
-il_fof = df_il[df_il["Vértice"] == f"D+{prazo_resgate_fof}"]["IL"].values[0]
-mismatch_val = df_carteira[df_carteira["Prazo"] > prazo_resgate_fof]["Valor"].sum()
-mismatch_perc = (mismatch_val / pl_total * 100) if pl_total > 0 else 0
+    k1, k2, k3 = st.columns(3)
+    k1.metric(f"IL em D+{prazo_resgate_fof}", f"{il_fof:.2f}" if not np.isnan(il_fof) else "N/A")
+    k2.metric("Mismatch (> prazo FoF %)", f"{mismatch_perc:.1f}%")
+    k3.metric("PL Total (R$)", f"{pl_total:,.2f}")
 
-k1, k2, k3 = st.columns(3)
-k1.metric(f"IL em D+{prazo_resgate_fof}", f"{il_fof:.2f}" if not np.isnan(il_fof) else "N/A")
-k2.metric("Mismatch (> prazo FoF %)", f"{mismatch_perc:.1f}%")
-k3.metric("PL Total (R$)", f"{pl_total:,.2f}")
+    # -----------------------------------
+    # GRÁFICO: OFERTA VS DEMANDA
+    # -----------------------------------
+    fig = _build_fig(
+        tuple(df_il["Vértice"]),
+        tuple(oferta_vec.tolist()),
+        tuple(demanda_vec.tolist())
+    )
+    st.plotly_chart(fig)
 
-# -----------------------------------
-# GRÁFICO: OFERTA VS DEMANDA
-# -----------------------------------
-fig = go.Figure()
-fig.add_trace(go.Bar(x=df_il["Vértice"], y=df_il["Oferta"], name="Oferta Acumulada", marker_color="#00CC96"))
-fig.add_trace(go.Scatter(x=df_il["Vértice"], y=df_il["DemandaEstressada"],
-                         name="Demanda Estressada", line=dict(color="red", width=3)))
-fig.update_layout(title="Cobertura de Liquidez por Vértice", barmode="group", hovermode="x unified")
-st.plotly_chart(fig)
+    # -----------------------------------
+    # ALERTAS (COM BASE NOS LIMITES)
+    # -----------------------------------
+    if not np.isnan(il_fof):
+        if il_fof < 1:
+            st.error(f"🚨 Risco: IL < 1 em D+{prazo_resgate_fof}")
+        elif il_fof < 1.25:
+            st.warning("⚠️ IL em zona de atenção (soft limit).")
+        else:
+            st.success("✅ IL confortável.")
 
-# -----------------------------------
-# ALERTAS (COM BASE NOS LIMITES)
-# -----------------------------------
-if not np.isnan(il_fof):
-    if il_fof < 1:
-        st.error(f"🚨 Risco: IL < 1 em D+{prazo_resgate_fof}")
-    elif il_fof < 1.25:
-        st.warning("⚠️ IL em zona de atenção (soft limit).")
-    else:
-        st.success("✅ IL confortável.")
+    if mismatch_perc > 25:
+        st.warning("⚠️ Mismatch > 25% do PL — revisar carteira.")
 
-if mismatch_perc > 25:
-    st.warning("⚠️ Mismatch > 25% do PL — revisar carteira.")
+_carteira_block(pl_total, demanda_por_vertice, vertices, prazo_resgate_fof)
@@ -0,0 +1,76 @@
+import numpy as np
+from numba import guvectorize, njit
+
+# -----------------------------------
+# KERNELS NUMÉRICOS (NUMBA)
+# -----------------------------------
+# Ficam fora do app.py porque o Streamlit reexecuta o script inteiro a cada
+# interação; aqui o módulo é importado (e compilado) uma única vez por processo.
+
+@guvectorize(
+    ["void(f8[:], f8[:], f8[:], f8[:])"],
+    "(n),(n)->(n),(n)",
+    nopython=True,
+    cache=True,
+)
+def fluxos(aportes, resgates, fluxo_liquido, fluxo_risco):
+    """
+    Fluxo líquido (aportes - resgates) e fluxo de risco (saída líquida,
+    em módulo; zero nos dias de entrada) num único laço.
+    """
+    for i in range(aportes.shape[0]):
+        d = aportes[i] - resgates[i]
+        fluxo_liquido[i] = d
+        # d != d filtra NaN antes do "<", que com NaN levanta o flag de FP inválido
+        # (RuntimeWarning); fluxo em branco conta como zero de risco
+        if d != d:
+            fluxo_risco[i] = 0.0
+        else:
+            fluxo_risco[i] = -d if d < 0 else 0.0
+
+@njit(cache=True)
+def _percentil_99(valores):
+    """
+    Percentil 99 com interpolação linear (mesmo resultado de np.percentile),
+    via seleção O(N) com np.partition em vez de ordenar o array inteiro.
+    """
+    pos = 0.99 * (valores.size - 1)
+    lo = int(np.floor(pos))
+    frac = pos - lo
+    parcial = np.partition(valores, lo)
+    v_lo = parcial[lo]
+    if frac == 0.0:
+        return v_lo
+    # o próximo valor ordenado é o mínimo do que ficou à direita de lo
+    v_hi = parcial[lo + 1:].min()
+    return v_lo + frac * (v_hi - v_lo)
+
+@njit(cache=True)
+def demand_all(risco, windows):
+    """
+    Para cada janela em windows (dias), calcula o percentil 99 da soma
+    móvel de risco em janelas daquele comprimento, mantendo uma soma
+    corrente em vez de re-somar cada janela.
+    Janelas maiores que o histórico resultam em 0.0.
+    """
+    n = risco.size
+    demandas = np.zeros(windows.size)
+    for j in range(windows.size):
+        v = windows[j]
+        if v <= 0 or n < v:
+            continue
+
+        rolling_sums = np.empty(n - v + 1)
+        s = 0.0
+        for i in range(v):
+            s += risco[i]
+        rolling_sums[0] = s
+        for i in range(v, n):
+            s += risco[i] - risco[i - v]
+            rolling_sums[i - v + 1] = s
+
+        demandas[j] = _percentil_99(rolling_sums)
+    return demandas
+
+# Aquecimento: compila no import para não pagar a latência do JIT no primeiro clique
+demand_all(np.zeros(2), np.array([1], dtype=np.int64))